@@ -1,39 +1,42 @@
 import psycopg2 as pg
+from psycopg2 import sql
+from psycopg2.pool import ThreadedConnectionPool
 import datetime
-from configparser import ConfigParser
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import string
 import requests  # Import requests for Slack notifications
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from Duplicates_Common import (DEFAULT_LOOKBACK_DAYS, DEFAULT_STATEMENT_TIMEOUT, DEFAULT_WORKERS, SMTPSession,
+                               get_skip_reason, get_table_stats, load_all_configs, load_state, log_to_file, logger,
+                               parse_args, save_state, send_email, server_config, set_statement_timeout,
+                               setup_logging)
 
 # Log file for recording operations and errors
-log_file = 'dropduplicates.log'
+setup_logging('checkduplicates.log')
 
-def log_to_file(message):
-    """Append a message to the log file with a timestamp."""
-    with open(log_file, 'a') as log:
-        log.write(f"{datetime.datetime.now()} - {message}\n")
+# Number of background threads sending email and Slack notifications
+NOTIFY_WORKERS = 4
 
-def send_email(subject, body, email_config):
-    """Send an email using SMTP, getting configurations from email configuration."""
-    try:
-        # Set up the SMTP server
-        server = smtplib.SMTP_SSL(email_config['smtp_host'], email_config['smtp_port'])
-        server.login(email_config['smtp_username'], email_config['smtp_password'])
-
-        # Create email message
-        msg = MIMEMultipart()
-        msg['From'] = email_config['sender_email']
-        msg['To'] = email_config['receiver_email']
-        msg['Subject'] = subject
-        msg.attach(MIMEText(body, 'plain'))
-
-        # Send the email
-        server.sendmail(email_config['sender_email'], email_config['receiver_email'], msg.as_string())
-        server.quit()
-        print(f"Email sent at {datetime.datetime.now()}\n")
-    except Exception as e:
-        log_to_file(f"Failed to send email: {e}")
+# Seconds to wait for Slack before giving up on an alert
+SLACK_TIMEOUT = 5
+
+# Shared HTTPS session so the connection to Slack is kept alive across alerts
+slack_session = requests.Session()
+slack_session.mount('https://', HTTPAdapter(pool_connections=NOTIFY_WORKERS, pool_maxsize=NOTIFY_WORKERS,
+                                            max_retries=Retry(total=3, backoff_factor=0.2)))
+
+# Number of tables scanned by a single UNION ALL query, paying Redshift's query compilation once per batch
+TABLES_PER_QUERY = 20
+
+# Number of example keys listed per duplicate count in the alerts
+SAMPLE_KEYS = 10
+
+# Table stats seen by the previous run; clean tables whose row count and last insert have not changed
+# are not scanned again
+STATE_FILE = os.path.expanduser('~/.duplicates_check_state.json')
 
 def send_slack_alert(message, slack_webhook_url):
     """Send an alert message to a Slack channel using a webhook URL."""
@@ -43,114 +46,233 @@ def send_slack_alert(message, slack_webhook_url):
             "username": "Duplicates Checker",
             "icon_emoji": ":warning:"
         }
-        response = requests.post(slack_webhook_url, json=payload)
+        response = slack_session.post(slack_webhook_url, json=payload, timeout=SLACK_TIMEOUT)
         if response.status_code != 200:
             log_to_file(f"Failed to send Slack alert: {response.text}")
         else:
-            print("Slack alert sent successfully.")
+            logger.debug("Slack alert sent successfully.")
     except Exception as e:
         log_to_file(f"Error sending Slack alert: {e}")
 
-def server_config(filename, section):
-    """Read configuration from an ini file."""
-    parser = ConfigParser()
-    parser.read(filename)
-    db = {}
-    if parser.has_section(section):
-        params = parser.items(section)
-        for param in params:
-            db[param[0]] = param[1]
-    else:
-        raise Exception(f'Section {section} not found in the {filename} file')
-    return db
+def log_notification_errors(future):
+    """Log an exception raised by a notification sent in the background."""
+    if future.exception() is not None:
+        log_to_file(f"Notification failed: {future.exception()}")
+
+# Alert templates, rendered once per table with duplicates
+EMAIL_SUBJECT_TEMPLATE = string.Template("Duplicate(s) found in $database.$table at $detected_at")
+EMAIL_BODY_TEMPLATE = string.Template("""Duplicate(s) found in $database.$table at $detected_at.
+
+DETAILS:
+Source Host: $host
+Source Replication Task: $replication_task
+Source Database: $database
+Source Table: $table
+Source Column: $unique_key
 
-def get_table_config(section, config_path='/r_duplicates.ini'):
-    """Get the table configuration for a given section from an ini file."""
-    return server_config(config_path, section)
+Total number of rows = $total_rows
+
+$details""")
+SLACK_TEMPLATE = string.Template("Alert: Duplicates found in $database.$table:\n$details")
 
 def print_duplicate_info(database_name, table_name, grouped_duplicates):
-    """Print and return formatted information about duplicates."""
-    output = f"\nDuplicates found in {database_name}.{table_name}:\n"
-    for duplicate_count, rows in grouped_duplicates.items():
-        output += f"{len(rows)} row(s) affected: with {duplicate_count} duplicates per row\n"
-    print(output)
+    """Log and return formatted information about duplicates grouped as (duplicate_count, row_count, sample_keys)."""
+    output = f"\nDuplicates found in {database_name}.{table_name}:\n" + "".join(
+        f"{row_count} row(s) affected: with {duplicate_count} duplicates per row (e.g. {sample_keys})\n"
+        for duplicate_count, row_count, sample_keys in grouped_duplicates
+    )
+    log_to_file(output.strip())  # Called from the scan workers; the logger keeps reports from interleaving
     return output
 
-def get_duplicates_and_alert():
-    """Check for duplicates in specified tables and send alerts via email and Slack."""
-    parser = ConfigParser()
-    parser.read('/r_duplicates.ini')
-    
-    email_config = server_config('/r_emailConfig.ini', 'email_config')
-    slack_webhook_url = email_config['slack_webhook_url']  # Fetching Slack webhook URL
+# Duplicated rows of one table in Unique_key column, tagged with the table they come from so that
+# several tables can be scanned by a single UNION ALL query. Rows without a key are not duplicates.
+DUPLICATE_PART_SQL = sql.SQL("""
+        SELECT {src}::varchar AS src, dateCreated, {unique_key}::varchar AS row_key, COUNT(*) AS duplicate_count
+        FROM {db_table}
+        WHERE {unique_key} IS NOT NULL
+        {date_filter}
+        GROUP BY dateCreated, {unique_key}
+        HAVING COUNT(*) > 1
+""")
+
+# Query to find duplicates in a batch of tables, grouped by table and by how many times each row is
+# duplicated so that only one row per table and distinct duplicate count is returned
+DUPLICATE_SUMMARY_SQL = sql.SQL("""
+    WITH duplicates AS ({duplicates}
+    ), ranked AS (
+        SELECT src, duplicate_count, row_key,
+               ROW_NUMBER() OVER (PARTITION BY src, duplicate_count ORDER BY dateCreated DESC) AS sample_rn
+        FROM duplicates
+    )
+    SELECT src, duplicate_count, COUNT(*) AS row_count,
+           LISTAGG(CASE WHEN sample_rn <= {sample_keys} THEN row_key END, ', ')
+               WITHIN GROUP (ORDER BY sample_rn) AS sample_keys
+    FROM ranked
+    GROUP BY src, duplicate_count
+    ORDER BY src, duplicate_count;
+""")
+
+# Restricts a scan to the last {lookback_days} days of data
+LOOKBACK_FILTER_SQL = sql.SQL("AND dateCreated >= DATEADD(day, -{lookback_days}, CURRENT_DATE)")
+
+def build_batch_query(batch, full_scan=False):
+    """Compose one UNION ALL duplicate query for a batch of (db_table, table_config) pairs."""
+    parts = []
+    for db_table, table_config in batch:
+        # Only scan recent rows so Redshift can prune blocks by the sort key, unless a full scan is requested
+        lookback_days = int(table_config.get('lookback_days', DEFAULT_LOOKBACK_DAYS))
+        date_filter = sql.SQL("") if full_scan else LOOKBACK_FILTER_SQL.format(lookback_days=sql.Literal(lookback_days))
+
+        parts.append(DUPLICATE_PART_SQL.format(
+            src=sql.Literal(db_table),
+            unique_key=sql.Identifier(table_config['unique_key']),
+            db_table=sql.Identifier(table_config['database'], table_config['table']),
+            date_filter=date_filter,
+        ))
 
+    return DUPLICATE_SUMMARY_SQL.format(duplicates=sql.SQL(" UNION ALL ").join(parts),
+                                        sample_keys=sql.Literal(SAMPLE_KEYS))
+
+def scan_batch(pool, batch, full_scan=False, statement_timeout=DEFAULT_STATEMENT_TIMEOUT):
+    """Scan a batch of tables with one query; return {db_table: [(duplicate_count, row_count, sample_keys)]}."""
+    conn = pool.getconn()
     try:
-        # Establish connection to Redshift
-        with pg.connect(**server_config('/r_duplicates.ini', 'yoda_r_lake')) as conn:
+        set_statement_timeout(conn, statement_timeout)
+        with conn:
             with conn.cursor() as cur:
-                # Loop through each section (table) in the config
-                for section in parser.sections():
-                    if section.startswith('yoda_hub'):
-                        table_config = get_table_config(section)
-
-                        # Extract necessary table parameters
-                        unique_key = table_config['unique_key']
-                        database_name = table_config['database']
-                        table_name = table_config['table']
-                        host_name = table_config['host']
-                        replication_task = table_config['replication_task']
-
-                        # Query to find duplicates in Unique_key column
-                        query = f"""
-                            SELECT dateCreated, {unique_key}, COUNT(*)
-                            FROM {database_name}.{table_name}
-                            GROUP BY dateCreated, {unique_key}
-                            HAVING COUNT(*) > 1
-                            ORDER BY dateCreated DESC;
-                        """
-
-                        # Execute the query and fetch the results
-                        cur.execute(query)
-                        duplicate_results = cur.fetchall()
-
-                        if duplicate_results:
-                            total_rows = len(duplicate_results)
-                            grouped_duplicates = {}
-                            for row in duplicate_results:
-                                date_created, row_key, duplicate_count = row
-                                grouped_duplicates.setdefault(duplicate_count, []).append(row_key)
-
-                            # Construct the email message
-                            subject = f"Duplicate(s) found in {database_name}.{table_name} at {datetime.datetime.now()}"
-                            text = (f"Duplicate(s) found in {database_name}.{table_name} at {datetime.datetime.now()}.\n\n"
-                                    f"DETAILS:\n"
-                                    f"Source Host: {host_name}\n"
-                                    f"Source Replication Task: {replication_task}\n"
-                                    f"Source Database: {database_name}\n"
-                                    f"Source Table: {table_name}\n"
-                                    f"Source Column: {unique_key}\n\n"
-                                    f"Total number of rows = {total_rows}\n\n")
-
-                            output_text = print_duplicate_info(database_name, table_name, grouped_duplicates)
-                            text += output_text
-
-                            # Send Email Alert
-                            send_email(subject, text, email_config)
-
-                            # Send Slack Alert
-                            slack_message = f"Alert: Duplicates found in {database_name}.{table_name}:\n{output_text}"
-                            send_slack_alert(slack_message, slack_webhook_url)
-                        else:
-                            print(f"No duplicate found in {database_name}.{table_name} at {datetime.datetime.now()}")
+                # Execute the query and split the results back per table
+                cur.execute(build_batch_query(batch, full_scan))
+                grouped = {db_table: [] for db_table, table_config in batch}
+                for db_table, duplicate_count, row_count, sample_keys in cur.fetchall():
+                    grouped[db_table].append((duplicate_count, row_count, sample_keys))
+                return grouped
+    finally:
+        pool.putconn(conn)
+
+def alert_duplicates(table_config, grouped_duplicates, detected_at, smtp, slack_webhook_url, notify_pool):
+    """Send email and Slack alerts for a table's duplicates found at detected_at, if it has any."""
+    # Extract necessary table parameters
+    unique_key = table_config['unique_key']
+    database_name = table_config['database']
+    table_name = table_config['table']
+    host_name = table_config['host']
+    replication_task = table_config['replication_task']
+
+    if grouped_duplicates:
+        total_rows = sum(row_count for duplicate_count, row_count, sample_keys in grouped_duplicates)
+
+        # Construct the email message
+        alert = {
+            'database': database_name,
+            'table': table_name,
+            'detected_at': detected_at,
+            'host': host_name,
+            'replication_task': replication_task,
+            'unique_key': unique_key,
+            'total_rows': total_rows,
+            'details': print_duplicate_info(database_name, table_name, grouped_duplicates),
+        }
+        subject = EMAIL_SUBJECT_TEMPLATE.substitute(alert)
+        text = EMAIL_BODY_TEMPLATE.substitute(alert)
+
+        # Send Email Alert in the background so the scan is not held up by SMTP
+        notify_pool.submit(send_email, subject, text, smtp).add_done_callback(log_notification_errors)
+
+        # Send Slack Alert in the background
+        slack_message = SLACK_TEMPLATE.substitute(alert)
+        notify_pool.submit(send_slack_alert, slack_message, slack_webhook_url).add_done_callback(log_notification_errors)
+    else:
+        log_to_file(f"No duplicate found in {database_name}.{table_name} at {detected_at}")
+
+def process_batch(pool, batch, smtp, slack_webhook_url, notify_pool, full_scan=False,
+                  statement_timeout=DEFAULT_STATEMENT_TIMEOUT):
+    """Check a batch of tables for duplicates and send alerts; return the tables found without duplicates."""
+    db_tables = [db_table for db_table, table_config in batch]
+    try:
+        results = scan_batch(pool, batch, full_scan, statement_timeout)
+    except Exception as err:
+        if isinstance(err, pg.extensions.QueryCanceledError):
+            reason = "exceeded the statement timeout"
+        else:
+            reason = f"failed with error: {err}"
+
+        if len(batch) == 1:
+            log_to_file(f"Fetching duplicates from {db_tables[0]} {reason}")
+            return []
+
+        # One slow or broken table should not cost the others their check; retry them one query each
+        log_to_file(f"Fetching duplicates from {', '.join(db_tables)} {reason}; checking them one at a time")
+        return [checked for entry in batch
+                for checked in process_batch(pool, [entry], smtp, slack_webhook_url, notify_pool,
+                                             full_scan, statement_timeout)]
+
+    # One timestamp for the whole batch, which was scanned by a single query
+    detected_at = datetime.datetime.now().isoformat(sep=' ', timespec='seconds')
+    for db_table, table_config in batch:
+        alert_duplicates(table_config, results[db_table], detected_at, smtp, slack_webhook_url, notify_pool)
+    return [db_table for db_table in db_tables if not results[db_table]]
+
+def get_duplicates_and_alert(smtp, slack_webhook_url, notify_pool, full_scan=False, workers=DEFAULT_WORKERS,
+                             statement_timeout=DEFAULT_STATEMENT_TIMEOUT):
+    """Check for duplicates in specified tables and send alerts via email and Slack."""
+    table_configs = load_all_configs('/r_duplicates.ini')
+
+    # Every section (table) in the config that should be checked
+    sections = [table_config for section, table_config in table_configs.items() if section.startswith('yoda_hub')]
+
+    pool = None
+    try:
+        # Establish a pool of connections to Redshift shared by the worker threads
+        pool = ThreadedConnectionPool(minconn=min(2, workers), maxconn=workers,
+                                      **server_config('/r_duplicates.ini', 'yoda_r_lake'))
+
+        # Skip tables that are empty or have not changed since the previous run
+        db_tables = [f"{table_config['database']}.{table_config['table']}" for table_config in sections]
+        table_stats = get_table_stats(pool, db_tables) if db_tables else None
+        state = load_state(STATE_FILE)
+
+        to_scan = []
+        for db_table, table_config in zip(db_tables, sections):
+            skip_reason = get_skip_reason(db_table, table_stats, state, full_scan)
+            if skip_reason:
+                log_to_file(f"Skipping {db_table}: {skip_reason}.")
+            else:
+                to_scan.append((db_table, table_config))
+
+        # Check the tables in batches of one UNION ALL query each, the batches running concurrently
+        # with one pooled connection per worker
+        batches = [to_scan[i:i + TABLES_PER_QUERY] for i in range(0, len(to_scan), TABLES_PER_QUERY)]
+        worker = partial(process_batch, pool, smtp=smtp, slack_webhook_url=slack_webhook_url,
+                         notify_pool=notify_pool, full_scan=full_scan, statement_timeout=statement_timeout)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Remember the stats of every table found without duplicates; tables with duplicates keep
+            # being scanned and alerted on until they are clean
+            for clean_tables in executor.map(worker, batches):
+                for db_table in clean_tables:
+                    if table_stats is not None and db_table.lower() in table_stats:
+                        state[db_table] = table_stats[db_table.lower()]
+        save_state(state, STATE_FILE)
 
     except Exception as err:
         log_to_file(f"Fetching duplicates from Redshift failed with error: {err}")
+    finally:
+        if pool:
+            pool.closeall()
 
 def main():
     """Main function to start the duplicate checking job."""
+    args = parse_args("Check Redshift tables for duplicates and send alerts.")
+
     start_time = datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S")
     print("\n........Starting Job..................", start_time, "\n")
-    get_duplicates_and_alert()
+    email_config = server_config('/r_emailConfig.ini', 'email_config')
+    slack_webhook_url = email_config['slack_webhook_url']  # Fetching Slack webhook URL
+
+    # One SMTP connection for every alert sent during the run; alerts are sent by background workers
+    # and the pool waits for the pending ones before the SMTP connection is closed
+    with SMTPSession(email_config) as smtp, ThreadPoolExecutor(max_workers=NOTIFY_WORKERS) as notify_pool:
+        get_duplicates_and_alert(smtp, slack_webhook_url, notify_pool, full_scan=args.full, workers=args.workers,
+                                 statement_timeout=args.statement_timeout)
     end_time = datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S")
     print("\n.......Job Finished.......", end_time, "\n")
 
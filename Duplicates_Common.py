@@ -0,0 +1,219 @@
+"""Helpers shared by Check_Duplicates.py and Remove_Duplicates.py: logging, configuration, email,
+table skipping and command line options."""
+import argparse
+import json
+import logging
+from logging.handlers import RotatingFileHandler
+import os
+from functools import lru_cache
+from configparser import ConfigParser
+try:
+    import tomllib
+except ImportError:  # Python < 3.11 reads the legacy ini files only
+    tomllib = None
+import smtplib
+import threading
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+# Number of tables queried concurrently, and the size of the Redshift connection pool, unless --workers is given.
+# Redshift runs the queries in parallel up to the WLM queue's slot count, so this should match it.
+DEFAULT_WORKERS = 8
+
+# Days of recent data scanned for duplicates unless a section sets lookback_days or --full is given
+DEFAULT_LOOKBACK_DAYS = 28
+
+# Milliseconds a single query may run before Redshift cancels it, unless --statement-timeout is given
+DEFAULT_STATEMENT_TIMEOUT = 600000
+
+# Logger kept open for the whole run; the handler serializes writes from the worker threads
+logger = logging.getLogger('redshift_duplicates')
+
+def setup_logging(log_file):
+    """Write the log to log_file, rotated at 10 MB with 5 backups.
+
+    Each script logs to its own file because each process rotates its own file and the two jobs may overlap.
+    """
+    log_handler = RotatingFileHandler(log_file, maxBytes=10 << 20, backupCount=5, delay=True)
+    log_handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+    logger.addHandler(log_handler)
+    logger.setLevel(logging.INFO)
+
+def log_to_file(message):
+    """Append a message to the log file with a timestamp."""
+    logger.info(message)  # The timestamp is added by the log formatter
+
+class SMTPSession:
+    """A single SMTP connection shared by every email sent during a run.
+
+    The connection is opened on the first email, reused for the following ones and reopened
+    if the server drops it or the previous login failed.
+    """
+
+    def __init__(self, email_config):
+        self.email_config = email_config
+        self._server = None
+        self._lock = threading.Lock()  # Tables are processed concurrently; one message at a time on the wire
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _connect(self):
+        """Open the SMTP connection and log in."""
+        server = smtplib.SMTP_SSL(self.email_config['smtp_host'], self.email_config['smtp_port'])
+        server.login(self.email_config['smtp_username'], self.email_config['smtp_password'])
+        self._server = server
+
+    def sendmail(self, message):
+        """Send a message, reconnecting once if the connection was dropped."""
+        with self._lock:
+            if self._server is None:
+                self._connect()
+            try:
+                self._server.sendmail(self.email_config['sender_email'], self.email_config['receiver_email'], message)
+            except smtplib.SMTPServerDisconnected:
+                self._server = None
+                self._connect()
+                self._server.sendmail(self.email_config['sender_email'], self.email_config['receiver_email'], message)
+
+    def close(self):
+        """Quit the SMTP connection if it was opened."""
+        with self._lock:
+            if self._server is not None:
+                try:
+                    self._server.quit()
+                except smtplib.SMTPException:
+                    pass
+                self._server = None
+
+def send_email(subject, body, smtp):
+    """Send an email over the shared SMTP session, getting addresses from its email configuration."""
+    try:
+        # Create email message
+        msg = MIMEMultipart()
+        msg['From'] = smtp.email_config['sender_email']
+        msg['To'] = smtp.email_config['receiver_email']
+        msg['Subject'] = subject
+        msg.attach(MIMEText(body, 'plain'))
+
+        # Send the email
+        smtp.sendmail(msg.as_string())
+        logger.debug("Email sent: %s", subject)
+    except Exception as e:
+        log_to_file(f"Failed to send email: {e}")
+
+@lru_cache(maxsize=None)
+def _parse_config(filename, mtime):
+    """Parse a TOML or ini file once per modification time into a dict of sections."""
+    log_to_file(f"Reading configuration from {filename}")
+    if filename.endswith('.toml'):
+        with open(filename, 'rb') as config_file:
+            return tomllib.load(config_file)  # Top-level tables are the sections
+
+    parser = ConfigParser()
+    parser.read(filename)
+    return {section: dict(parser.items(section)) for section in parser.sections()}
+
+def load_all_configs(filename):
+    """Return every section of a config file, reusing the cached parse while the file is unchanged.
+
+    The requested .ini file is read while it exists; otherwise the .toml file next to it is read instead.
+    """
+    if not os.path.exists(filename):
+        toml_filename = os.path.splitext(filename)[0] + '.toml'
+        if os.path.exists(toml_filename):
+            if tomllib is None:
+                raise Exception(f'{toml_filename} can only be read on Python 3.11 or higher (tomllib); '
+                                f'provide {filename} with the same sections on older Pythons')
+            filename = toml_filename
+
+    mtime = os.path.getmtime(filename) if os.path.exists(filename) else None
+    return _parse_config(filename, mtime)
+
+def server_config(filename, section):
+    """Read the database or email configuration from a file."""
+    configs = load_all_configs(filename)  # Parsed once and cached per modification time
+    if section not in configs:
+        raise Exception(f'Section {section} not found in the {filename} file')
+    return dict(configs[section])  # Return a copy so callers cannot alter the cache
+
+# Row count and last insert time of the configured tables, read from Redshift's table metadata and
+# insert log instead of scanning them. stl_insert keeps a few days of history and only shows other
+# users' inserts to superusers or users with SYSLOG ACCESS UNRESTRICTED; without a visible insert the
+# last insert time is NULL.
+TABLE_STATS_SQL = """
+    SELECT LOWER(i."schema" || '.' || i."table"), i.tbl_rows, MAX(s.endtime)
+    FROM svv_table_info i
+    LEFT JOIN stl_insert s ON s.tbl = i.table_id
+    WHERE LOWER(i."schema" || '.' || i."table") IN %s
+    GROUP BY 1, 2;
+"""
+
+def get_table_stats(pool, db_tables):
+    """Return [row_count, last_insert] of each lowercased 'database.table', or None if they cannot be read.
+
+    Tables missing from the result (e.g. not visible to the job user) have unknown stats.
+    """
+    conn = pool.getconn()
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute(TABLE_STATS_SQL, (tuple(db_table.lower() for db_table in db_tables),))
+                # Lists with ISO timestamps so that they compare equal to the stats read back from the state file
+                return {name: [int(rows), last_insert and last_insert.isoformat()]
+                        for name, rows, last_insert in cur.fetchall()}
+    except Exception as err:
+        log_to_file(f"Reading table stats from svv_table_info failed, scanning every table: {err}")
+        return None
+    finally:
+        pool.putconn(conn)
+
+def load_state(state_file):
+    """Read the table stats recorded by the previous run."""
+    try:
+        with open(state_file) as state:
+            return json.load(state)
+    except (OSError, ValueError):
+        return {}
+
+def save_state(state, state_file):
+    """Record the stats of the tables processed in this run."""
+    try:
+        with open(state_file, 'w') as state_out:
+            json.dump(state, state_out, indent=2, sort_keys=True)
+    except OSError as err:
+        log_to_file(f"Failed to save state to {state_file}: {err}")
+
+def get_skip_reason(db_table, table_stats, state, full_scan=False):
+    """Return why a table does not need to be scanned this run, or None if it does."""
+    stats = None if table_stats is None else table_stats.get(db_table.lower())
+    if stats is None:
+        return None  # Table stats unknown; scan it
+    rows, last_insert = stats
+    if rows < 2:
+        return "fewer than 2 rows"
+    if not full_scan and state.get(db_table) == stats:
+        return f"row count ({rows}) and last insert ({last_insert}) unchanged since last run"
+    return None
+
+def set_statement_timeout(conn, statement_timeout):
+    """Make Redshift cancel any query on the connection that runs longer than statement_timeout milliseconds."""
+    with conn.cursor() as cur:
+        cur.execute("SET statement_timeout TO %s;", (int(statement_timeout),))
+    conn.commit()
+
+def parse_args(description):
+    """Parse the command line options shared by both scripts."""
+    arg_parser = argparse.ArgumentParser(description=description)
+    arg_parser.add_argument('--full', action='store_true',
+                            help="scan whole tables instead of the last lookback_days of data (initial bootstrap run)")
+    arg_parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                            help="tables queried concurrently; match the WLM query slots available to the job user "
+                                 f"(default {DEFAULT_WORKERS})")
+    arg_parser.add_argument('--statement-timeout', type=int, default=DEFAULT_STATEMENT_TIMEOUT,
+                            help="milliseconds after which a duplicate check is cancelled and its table skipped "
+                                 f"(default {DEFAULT_STATEMENT_TIMEOUT})")
+    return arg_parser.parse_args()
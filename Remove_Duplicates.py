@@ -1,213 +1,375 @@
 import psycopg2 as pg  # Import PostgreSQL adapter for Python
-import datetime  # Import datetime module to work with date and time
-from configparser import ConfigParser  # Import ConfigParser to handle configuration files
-import smtplib  # Import smtplib to send emails
-from email.mime.multipart import MIMEMultipart  # Import for creating multi-part email
-from email.mime.text import MIMEText  # Import for creating email body
+from psycopg2 import sql  # Import SQL composition helpers to quote identifiers safely
+from psycopg2.pool import ThreadedConnectionPool  # Import thread-safe PostgreSQL connection pool
+import datetime  # Import datetime to size dateCreated ranges of DATE columns
+import math  # Import math to round range widths up
+import os  # Import os to locate the state file
+from concurrent.futures import ThreadPoolExecutor  # Import thread pool to process tables concurrently
+from functools import partial  # Import partial to bind the shared arguments of the worker function
+# Import the logging, configuration, email, table skipping and command line helpers shared with Check_Duplicates.py
+from Duplicates_Common import (DEFAULT_LOOKBACK_DAYS, DEFAULT_STATEMENT_TIMEOUT, DEFAULT_WORKERS, SMTPSession,
+                               get_skip_reason, get_table_stats, load_all_configs, load_state, log_to_file,
+                               parse_args, save_state, send_email, server_config, set_statement_timeout,
+                               setup_logging)
 
 # Log file for recording operations and errors
-log_file = 'dropduplicates.log'
+setup_logging('dropduplicates.log')
+
+# Approximate number of rows deduplicated per transaction unless a section sets dedupe_batch_rows
+DEFAULT_DEDUPE_BATCH_ROWS = 10000000
+
+# Table stats seen by the previous run; tables whose row count and last insert have not changed are not
+# checked again
+STATE_FILE = os.path.expanduser('~/.dedupe_state.json')
+
+def table_identifier(db_table):
+    """Return the quoted identifier for a 'database.table' reference."""
+    return sql.Identifier(*db_table.split('.'))
+
+# SQL query probing for a single duplicate based on the unique key, composed once with the table's
+# identifiers; Redshift can stop at the first duplicate group instead of sorting all of them.
+# Rows without a key are never duplicates of each other and are left alone.
+DUPLICATE_CHECK_SQL = sql.SQL("""
+    SELECT 1
+    FROM {db_table}
+    WHERE {unique_key} IS NOT NULL
+    {date_filter}
+    GROUP BY dateCreated, {unique_key}
+    HAVING COUNT(*) > 1
+    LIMIT 1;
+""")
+
+# Restricts a scan to the last %(lookback_days)s days of data
+LOOKBACK_FILTER_SQL = sql.SQL("AND dateCreated >= DATEADD(day, -%(lookback_days)s, CURRENT_DATE)")
+
+def check_for_duplicates(cur, db_table, unique_key, smtp, lookback_days=None):
+    """Check if there are duplicates in the specified table, optionally only in the last lookback_days.
+
+    Returns True or False, or None if the check failed.
+    """
+    try:
+        # Restrict the scan to recent rows so Redshift can prune blocks by the sort key
+        date_filter = sql.SQL("") if lookback_days is None else LOOKBACK_FILTER_SQL
 
-def log_to_file(message):
-    """Append a message to the log file with a timestamp."""
-    with open(log_file, 'a') as log:
-        log.write(f"{datetime.datetime.now()} - {message}\n")
+        duplicate_check_query = DUPLICATE_CHECK_SQL.format(
+            unique_key=sql.Identifier(unique_key),
+            db_table=table_identifier(db_table),
+            date_filter=date_filter,
+        )
+        params = None if lookback_days is None else {'lookback_days': int(lookback_days)}
+        cur.execute(duplicate_check_query, params)  # Execute the query
 
-def send_email(subject, body):
-    """Send an email using SMTP, getting configurations from r_emailConfig.ini."""
-    try:
-        # Read email configuration from the specified ini file
-        email_config = server_config('r_emailConfig.ini', 'email_config')
-
-        # Set up the SMTP server using SSL for security
-        server = smtplib.SMTP_SSL(email_config['smtp_host'], email_config['smtp_port'])
-
-        # Log in to the email server with the provided credentials
-        server.login(email_config['smtp_username'], email_config['smtp_password'])
-
-        # Create an email message with the specified subject and body
-        msg = MIMEMultipart()
-        msg['From'] = email_config['sender_email']
-        msg['To'] = email_config['receiver_email']
-        msg['Subject'] = subject
-        msg.attach(MIMEText(body, 'plain'))  # Attach the email body in plain text
-
-        # Send the email to the recipient
-        server.sendmail(email_config['sender_email'], email_config['receiver_email'], msg.as_string())
-
-        # Quit the SMTP server after sending the email
-        server.quit()
-
-    except Exception as email_error:
-        # Log any errors that occur during the email sending process
-        log_to_file(f"Failed to send email: {email_error}")
-
-def server_config(filename, section):
-    """Read the database or email configuration from a file."""
-    parser = ConfigParser()  # Create a ConfigParser object
-    parser.read(filename)  # Read the configuration file
-
-    config = {}
-    if parser.has_section(section):
-        params = parser.items(section)  # Get all parameters in the specified section
-        for param in params:
-            config[param[0]] = param[1]  # Store parameters in a dictionary
-    else:
-        raise Exception(f'Section {section} not found in the {filename} file')
+        has_duplicates = cur.fetchone() is not None  # A row is returned only if a duplicate exists
+        cur.connection.commit()  # End the read transaction
 
-    return config  # Return the configuration dictionary
+        return has_duplicates
 
-def check_for_duplicates(cur, db_table, unique_key):
-    """Check if there are duplicates in the specified table."""
-    try:
-        # SQL query to find duplicates based on the unique key
-        duplicate_check_query = f"""
-                            SELECT dateCreated, {unique_key}, COUNT(*)
-                            FROM {db_table}
-                            GROUP BY dateCreated, {unique_key}
-                            HAVING COUNT(*) > 1
-                            ORDER BY dateCreated DESC;
-        """
-        cur.execute(duplicate_check_query)  # Execute the query
-        duplicate_keys = cur.fetchall()  # Fetch all duplicate keys
-
-        return duplicate_keys  # Return duplicates found (or empty if none)
+    except pg.extensions.QueryCanceledError:
+        # The check ran past the statement timeout; skip the table so the others are still processed
+        cur.connection.rollback()
+        log_to_file(f"Checking duplicates in {db_table} exceeded the statement timeout. Skipping...")
+        return None
 
     except Exception as e:
         # Log any errors encountered while checking for duplicates
+        cur.connection.rollback()
         log_to_file(f"Error checking duplicates in {db_table}: {str(e)}")
-        send_email("Error Checking Duplicates", f"Error checking duplicates in {db_table}: {str(e)}")
+        send_email("Error Checking Duplicates", f"Error checking duplicates in {db_table}: {str(e)}", smtp)
         return None  # Return None to indicate an error occurred
 
-def remove_duplicates_from_table(cur, db_table, unique_key):
-    """Function to remove duplicates from a specific table using procedural SQL steps."""
-    try:
-        # Step 1: Insert duplicates into a temporary table
-        step1_sql = f"""
-        BEGIN;
-
-        WITH duplicates_cte AS (
-            SELECT
-                COUNT(*) OVER (PARTITION BY {unique_key}) AS total_duplicates,  -- Count duplicates
-                ROW_NUMBER() OVER (PARTITION BY {unique_key} ORDER BY dateCreated) AS duplicate_rn,  -- Assign row number
-                *
-            FROM {db_table}
-        )
-        SELECT * 
-        INTO {db_table}_duplicates  -- Create a new table for duplicates
-        FROM duplicates_cte
-        WHERE total_duplicates > 1 AND duplicate_rn = 1;  -- Filter for duplicates
-
-        COMMIT;
-        """
-
-        cur.execute(step1_sql)  # Execute the SQL statement
-        log_to_file(f"Step 1: Duplicates inserted into temporary table for {db_table}.")
-
-        # Step 2: Remove duplicates from the main table
-        step2_sql = f"""
-        BEGIN;
-
-        DELETE FROM {db_table}  -- Delete duplicates from the main table
-        USING {db_table}_duplicates 
-        WHERE {db_table}_duplicates.{unique_key} = {db_table}.{unique_key};
-
-        COMMIT;
-        """
-
-        cur.execute(step2_sql)  # Execute the SQL statement
-        log_to_file(f"Step 2: Duplicates removed from {db_table}.")
-
-        # Step 3: Insert back the non-duplicate rows
-        step3_sql = f"""
-        BEGIN;
-
-        ALTER TABLE {db_table}_duplicates DROP COLUMN total_duplicates;  -- Remove extra columns
-        ALTER TABLE {db_table}_duplicates DROP COLUMN duplicate_rn;
-        INSERT INTO {db_table}  -- Insert the remaining non-duplicate rows back into the main table
-        SELECT * 
-        FROM {db_table}_duplicates;
-
-        COMMIT;
-        """
-
-        cur.execute(step3_sql)  # Execute the SQL statement
-        log_to_file(f"Step 3: Non-duplicate rows inserted back into {db_table}.")
-
-        # Step 4: Drop the temporary table
-        step4_sql = f"""
-        BEGIN;
-
-        DROP TABLE {db_table}_duplicates;  -- Remove the temporary table
-
-        COMMIT;
-        """
+# Delete-and-reinsert dedupe statement for a table or one dateCreated range, run in its own transaction. Redshift exposes no row
+# identifier (ctid), so the keeper of each duplicated key is staged in a session-scoped temp table;
+# only duplicated keys are deleted and re-inserted, the rest of the table is never rewritten.
+# Rows without a key never match the DELETE, so they are not staged either.
+DEDUPE_SQL = sql.SQL("""
+    CREATE TEMP TABLE {keepers_table} AS  -- Earliest row of every duplicated key
+    SELECT *
+    FROM {db_table}
+    WHERE {unique_key} IS NOT NULL
+    {range_filter}
+    QUALIFY COUNT(*) OVER (PARTITION BY {unique_key}) > 1
+        AND ROW_NUMBER() OVER (PARTITION BY {unique_key} ORDER BY dateCreated) = 1;
+
+    DELETE FROM {db_table}  -- Delete every row of the duplicated keys
+    USING {keepers_table}
+    WHERE {keepers_table}.{unique_key} = {db_table}.{unique_key}
+    {delete_range_filter};
+
+    INSERT INTO {db_table}  -- Insert the kept row of each duplicated key back
+    SELECT *
+    FROM {keepers_table};
+
+    DROP TABLE {keepers_table};
+""")
+
+# Deep copy of a table keeping the earliest row per key, swapped in place of the original in one
+# transaction so a failure leaves the original table untouched and no copy behind. The copy keeps the
+# column encodings, defaults, distribution and sort keys (LIKE) but not the owner, grants or constraints,
+# so it is only used on tables for which SWAP_CHECK_SQL finds none of those to lose. Rows without a key
+# are all kept.
+SWAP_SQL = sql.SQL("""
+    CREATE TABLE {dedupe_table} (LIKE {db_table} INCLUDING DEFAULTS);
+
+    INSERT INTO {dedupe_table}
+    SELECT *
+    FROM {db_table}
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY {unique_key} ORDER BY dateCreated) = 1 OR {unique_key} IS NULL;
+
+    DROP TABLE {db_table};
+
+    ALTER TABLE {dedupe_table} RENAME TO {table_name};
+""")
+
+# Whether a table can be swapped without losing anything the copy does not carry over: it must be owned
+# by the job user with no explicit grants, and have no constraints, no dependent (non late-binding) views
+# and no IDENTITY column, which INSERT ... SELECT * cannot write to
+SWAP_CHECK_SQL = """
+    SELECT
+        (SELECT COUNT(*)
+         FROM pg_class c
+         JOIN pg_namespace n ON n.oid = c.relnamespace
+         JOIN pg_user u ON u.usesysid = c.relowner
+         WHERE n.nspname = %(schema)s AND c.relname = %(table)s
+           AND u.usename = current_user AND c.relacl IS NULL) AS owned_without_grants,
+        (SELECT COUNT(*)
+         FROM pg_constraint k
+         JOIN pg_class c ON c.oid = k.conrelid
+         JOIN pg_namespace n ON n.oid = c.relnamespace
+         WHERE n.nspname = %(schema)s AND c.relname = %(table)s) AS constraints,
+        (SELECT COUNT(*)
+         FROM pg_depend d
+         JOIN pg_rewrite r ON r.oid = d.objid
+         JOIN pg_class c ON c.oid = d.refobjid
+         JOIN pg_namespace n ON n.oid = c.relnamespace
+         WHERE n.nspname = %(schema)s AND c.relname = %(table)s AND r.ev_class <> c.oid) AS dependent_views,
+        (SELECT COUNT(*)
+         FROM pg_attrdef a
+         JOIN pg_class c ON c.oid = a.adrelid
+         JOIN pg_namespace n ON n.oid = c.relnamespace
+         WHERE n.nspname = %(schema)s AND c.relname = %(table)s
+           AND a.adsrc LIKE '%%identity%%') AS identity_columns;
+"""
+
+def can_swap_table(cur, db_table):
+    """Return True if the table can be replaced by a deduplicated copy without losing anything the copy lacks."""
+    database_name, table_name = db_table.lower().split('.')
+    cur.execute(SWAP_CHECK_SQL, {'schema': database_name, 'table': table_name})
+    owned_without_grants, constraints, dependent_views, identity_columns = cur.fetchone()
+    return owned_without_grants == 1 and constraints == 0 and dependent_views == 0 and identity_columns == 0
+
+def build_swap_sql(db_table, unique_key):
+    """Compose the deep-copy-and-swap dedupe statement for a table."""
+    database_name, table_name = db_table.split('.')
+    return SWAP_SQL.format(
+        dedupe_table=sql.Identifier(database_name, f"{table_name}__dedupe"),
+        db_table=table_identifier(db_table),
+        unique_key=sql.Identifier(unique_key),
+        table_name=sql.Identifier(table_name),
+    )
+
+def build_dedupe_sql(db_table, unique_key, ranged=True):
+    """Compose the delete-and-reinsert dedupe statement for a table, by default for one dateCreated range."""
+    table = table_identifier(db_table)
+
+    # A ranged pass only reads and deletes rows whose dateCreated lies in [%(low)s, %(high)s)
+    if ranged:
+        range_filter = sql.SQL("AND dateCreated >= %(low)s AND dateCreated < %(high)s")
+        delete_range_filter = sql.SQL(
+            "AND {db_table}.dateCreated >= %(low)s AND {db_table}.dateCreated < %(high)s").format(db_table=table)
+    else:
+        range_filter = delete_range_filter = sql.SQL("")
+
+    return DEDUPE_SQL.format(
+        keepers_table=sql.Identifier(f"{db_table.split('.')[-1]}_keepers"),
+        db_table=table,
+        unique_key=sql.Identifier(unique_key),
+        range_filter=range_filter,
+        delete_range_filter=delete_range_filter,
+    )
+
+def get_dedupe_step(cur, db_table, batch_rows):
+    """Return (low, high, step) to walk the table in dateCreated ranges of about batch_rows rows, or None."""
+    cur.execute(sql.SQL("SELECT MIN(dateCreated), MAX(dateCreated), COUNT(*) FROM {db_table};").format(
+        db_table=table_identifier(db_table)))
+    low, high, row_count = cur.fetchone()
+
+    # Small or empty tables, and tables whose rows all share one dateCreated, are deduplicated in one pass
+    if low is None or row_count <= batch_rows or low == high:
+        return None
 
-        cur.execute(step4_sql)  # Execute the SQL statement
-        log_to_file(f"Step 4: Temporary table {db_table}_duplicates dropped.")
+    try:
+        step = (high - low) * batch_rows / row_count  # Range width expected to hold batch_rows rows
+    except TypeError:
+        return None  # dateCreated does not support range arithmetic
+
+    # Round the width up to the column's granularity so every range moves past the previous one
+    if isinstance(low, datetime.date) and not isinstance(low, datetime.datetime):
+        step = datetime.timedelta(days=max(1, math.ceil(step / datetime.timedelta(days=1))))
+    elif isinstance(low, int):
+        step = max(1, math.ceil(step))
+
+    if not low + step > low:
+        return None  # The ranges cannot advance
+
+    return low, high, step
+
+def dedupe_whole_table(cur, db_table, unique_key):
+    """Remove duplicates from the whole table in a single transaction.
+
+    The table is swapped for a deduplicated copy when nothing would be lost by dropping it; otherwise
+    the duplicated keys are deleted and their kept rows re-inserted in place.
+    """
+    if can_swap_table(cur, db_table):
+        cur.execute(build_swap_sql(db_table, unique_key))  # Execute the SQL statement
+        cur.connection.commit()  # Make the deduplicated copy visible atomically
+        log_to_file(f"Duplicates removed from {db_table} by swapping in a deduplicated copy.")
+    else:
+        cur.execute(build_dedupe_sql(db_table, unique_key, ranged=False))  # Execute the SQL statement
+        cur.connection.commit()
+        log_to_file(f"Duplicates removed from {db_table} in place; it cannot be swapped because of its owner, "
+                    f"grants, constraints, views or IDENTITY column.")
+
+def remove_duplicates_from_table(cur, db_table, unique_key, smtp, batch_rows=DEFAULT_DEDUPE_BATCH_ROWS):
+    """Remove duplicates from a specific table, keeping the earliest row per key; return True on success.
+
+    Tables up to batch_rows rows are deduplicated in one transaction, by swapping in a deduplicated
+    copy when that is safe.
+    Larger tables are processed in dateCreated ranges, each in its own short transaction; a key is
+    only deduplicated among rows that fall in the same range.
+    """
+    try:
+        bounds = get_dedupe_step(cur, db_table, int(batch_rows))
+
+        if bounds is None:
+            dedupe_whole_table(cur, db_table, unique_key)
+        else:
+            low, high, step = bounds
+            dedupe_sql = build_dedupe_sql(db_table, unique_key)
+
+            range_low = low
+            while range_low <= high:
+                range_high = range_low + step
+                if range_high <= range_low:
+                    # The range cannot advance; finish the table in one pass instead of looping forever
+                    dedupe_whole_table(cur, db_table, unique_key)
+                    break
+
+                cur.execute(dedupe_sql, {'low': range_low, 'high': range_high})
+                cur.connection.commit()  # Commit this range
+                log_to_file(f"Duplicates removed from {db_table} for dateCreated in [{range_low}, {range_high}).")
+                range_low = range_high
 
         # Send email notification once duplicates have been removed
         email_subject = f"Duplicate Removal Notification for {db_table}"
         email_body = f"Duplicates have been successfully removed from {db_table}."
-        send_email(email_subject, email_body)
+        send_email(email_subject, email_body, smtp)
+        return True
 
     except Exception as e:
         # Log any errors encountered while processing duplicates
         log_to_file(f"Error processing steps for {db_table}: {str(e)}")
-        send_email("Error Removing Duplicates", f"Error processing steps for {db_table}: {str(e)}")
-        # Optionally roll back the transaction in case of error
-        cur.execute("ROLLBACK;")
+        send_email("Error Removing Duplicates", f"Error processing steps for {db_table}: {str(e)}", smtp)
+        # Roll back the transaction in case of error
+        cur.connection.rollback()
         log_to_file(f"Transaction rolled back due to error.")
+        return False
+
+def process_section(pool, smtp, table_config, full_scan=False, statement_timeout=DEFAULT_STATEMENT_TIMEOUT):
+    """Check a single table for duplicates on a pooled connection and remove them; return True on success."""
+    # Extract table-specific parameters
+    table_name = table_config['table']
+    unique_key = table_config['unique_key']
+    db_table = f"{table_config['database']}.{table_name}"  # Full table reference
+    lookback_days = None if full_scan else table_config.get('lookback_days', DEFAULT_LOOKBACK_DAYS)
+    batch_rows = table_config.get('dedupe_batch_rows', DEFAULT_DEDUPE_BATCH_ROWS)
+
+    conn = pool.getconn()  # Borrow a connection from the pool
+    try:
+        conn.autocommit = False  # Each dedupe step commits its own transaction explicitly
+        set_statement_timeout(conn, statement_timeout)  # Bound how long the duplicate check may run
+        with conn.cursor() as cur:  # Create a cursor to execute queries
+            log_to_file(f"Checking for duplicates in {db_table}...")
+            has_duplicates = check_for_duplicates(cur, db_table, unique_key, smtp, lookback_days)  # Check for duplicates
+
+            if has_duplicates is None:  # The check failed and has already been reported
+                return False
+            if has_duplicates:  # If duplicates are found
+                log_to_file(f"Duplicates found in {db_table}. Processing...")
+                set_statement_timeout(conn, 0)  # The dedupe itself may legitimately run longer than a scan
+                return remove_duplicates_from_table(cur, db_table, unique_key, smtp, batch_rows)  # Remove duplicates
+
+            log_to_file(f"No duplicates found in {db_table}. Skipping...")
+            return True
+
+    except Exception as e:
+        # Log any errors so that the remaining tables are still processed
+        log_to_file(f"Failed to process {db_table}: {str(e)}")
+        send_email("Error in Duplicate Removal Process", f"Failed to process {db_table}: {str(e)}", smtp)
+        return False
 
-def remove_duplicates():
+    finally:
+        pool.putconn(conn)  # Return the connection to the pool
+
+def remove_duplicates(smtp, full_scan=False, workers=DEFAULT_WORKERS, statement_timeout=DEFAULT_STATEMENT_TIMEOUT):
     """Main function to remove duplicates from Redshift tables."""
-    parser = ConfigParser()  # Create a ConfigParser object
-    parser.read('r_duplicates.ini')  # Read the configuration file containing table details
+    table_configs = load_all_configs('r_duplicates.ini')  # Read the configuration file containing table details
+
+    # Every section in the config file that starts with 'yoda_hub'
+    sections = [table_config for section, table_config in table_configs.items() if section.startswith('yoda_hub')]
 
     # Get the Redshift connection details from the ini file
     config = server_config('r_duplicates.ini', 'yoda_r_lake')
-    conn = None  # Initialize connection variable
+    pool = None  # Initialize connection pool variable
     try:
         log_message = f"Connecting to {config['host']} database {config['database']}..."
         log_to_file(log_message)  # Log connection attempt
         print(log_message)  # Print connection message
 
-        # Establish connection to the Redshift database
-        conn = pg.connect(**config)
-        conn.autocommit = True  # Set autocommit mode
-        cur = conn.cursor()  # Create a cursor to execute queries
-
-        # Loop through each section in the config file that starts with 'yoda_hub'
-        for section in parser.sections():
-            if section.startswith('yoda_hub'):
-                table_config = server_config('r_duplicates.ini', section)
-
-                # Extract table-specific parameters
-                table_name = table_config['table']
-                unique_key = table_config['unique_key']
-                db_table = f"{table_config['database']}.{table_name}"  # Full table reference
-
-                log_to_file(f"Checking for duplicates in {db_table}...")
-                duplicate_keys = check_for_duplicates(cur, db_table, unique_key)  # Check for duplicates
-
-                if duplicate_keys:  # If duplicates are found
-                    print(f"Duplicates found in {db_table}. Processing...")
-                    log_to_file(f"Duplicates found in {db_table}. Processing...")
-                    remove_duplicates_from_table(cur, db_table, unique_key)  # Remove duplicates
-                else:
-                    print(f"No duplicates found in {db_table}. Skipping...")
-                    log_to_file(f"No duplicates found in {db_table}. Skipping...")
+        # Establish a pool of connections to the Redshift database shared by the worker threads
+        pool = ThreadedConnectionPool(minconn=min(2, workers), maxconn=workers, **config)
+
+        # Skip tables that are empty or have not changed since the previous run
+        db_tables = [f"{table_config['database']}.{table_config['table']}" for table_config in sections]
+        table_stats = get_table_stats(pool, db_tables) if db_tables else None
+        state = load_state(STATE_FILE)
+
+        to_process = []
+        for db_table, table_config in zip(db_tables, sections):
+            skip_reason = get_skip_reason(db_table, table_stats, state, full_scan)
+            if skip_reason:
+                log_to_file(f"Skipping {db_table}: {skip_reason}.")
+            else:
+                to_process.append((db_table, table_config))
+
+        # Process the tables concurrently, one pooled connection per worker
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            worker = partial(process_section, pool, smtp, full_scan=full_scan, statement_timeout=statement_timeout)
+            results = executor.map(worker, [table_config for db_table, table_config in to_process])
+
+            # Remember the stats of every table processed successfully
+            for (db_table, table_config), processed in zip(to_process, results):
+                if processed and table_stats is not None and db_table.lower() in table_stats:
+                    state[db_table] = table_stats[db_table.lower()]
+        save_state(state, STATE_FILE)
 
     except Exception as e:
         # Log any errors encountered during the duplicate removal process
         log_to_file(f"Failed to process: {str(e)}")
-        send_email("Error in Duplicate Removal Process", f"Failed to process: {str(e)}")
+        send_email("Error in Duplicate Removal Process", f"Failed to process: {str(e)}", smtp)
         print(f"Failed to process: {str(e)}")
 
     finally:
-        if conn:  # Close the database connection if it was opened
-            conn.close()
+        if pool:  # Close the database connections if they were opened
+            pool.closeall()
         print("Connection closed.")  # Print connection closure message
 
 if __name__ == '__main__':
-    remove_duplicates()  # Execute the main function when the script runs
+    args = parse_args("Remove duplicates from Redshift tables.")
+
+    # Read email configuration from the specified ini file
+    email_config = server_config('r_emailConfig.ini', 'email_config')
+
+    # One SMTP connection for every notification sent during the run
+    with SMTPSession(email_config) as smtp:
+        # Execute the main function when the script runs
+        remove_duplicates(smtp, full_scan=args.full, workers=args.workers, statement_timeout=args.statement_timeout)
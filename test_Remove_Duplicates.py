@@ -0,0 +1,63 @@
+import datetime
+import unittest
+from decimal import Decimal
+
+from Remove_Duplicates import get_dedupe_step
+
+
+class StubCursor:
+    """Cursor returning a fixed (MIN(dateCreated), MAX(dateCreated), COUNT(*)) row."""
+
+    def __init__(self, low, high, row_count):
+        self.row = (low, high, row_count)
+
+    def execute(self, query, params=None):
+        pass
+
+    def fetchone(self):
+        return self.row
+
+
+class GetDedupeStepTest(unittest.TestCase):
+    batch_rows = 10000000
+
+    def assert_ranges_advance(self, low, high, row_count):
+        """Walk the ranges like remove_duplicates_from_table and check that they reach past high."""
+        bounds = get_dedupe_step(StubCursor(low, high, row_count), 'schema.table', self.batch_rows)
+        self.assertIsNotNone(bounds)
+        range_low, range_high, step = bounds
+        ranges = 0
+        while range_low <= range_high:
+            self.assertGreater(range_low + step, range_low)
+            range_low += step
+            ranges += 1
+            self.assertLess(ranges, 100000)
+        return step
+
+    def test_date(self):
+        step = self.assert_ranges_advance(datetime.date(2024, 1, 1), datetime.date(2024, 1, 31), 1000000000)
+        self.assertEqual(step, datetime.timedelta(days=1))
+
+    def test_datetime(self):
+        self.assert_ranges_advance(datetime.datetime(2024, 1, 1), datetime.datetime(2024, 1, 1, 1), 1000000000)
+
+    def test_int(self):
+        step = self.assert_ranges_advance(0, 50, 1000000000)
+        self.assertEqual(step, 1)
+
+    def test_decimal(self):
+        self.assert_ranges_advance(Decimal('0'), Decimal('1'), 1000000000)
+
+    def test_single_value(self):
+        day = datetime.date(2024, 1, 1)
+        self.assertIsNone(get_dedupe_step(StubCursor(day, day, 1000000000), 'schema.table', self.batch_rows))
+
+    def test_non_numeric(self):
+        self.assertIsNone(get_dedupe_step(StubCursor('a', 'z', 1000000000), 'schema.table', self.batch_rows))
+
+    def test_small_table(self):
+        self.assertIsNone(get_dedupe_step(StubCursor(0, 50, self.batch_rows), 'schema.table', self.batch_rows))
+
+
+if __name__ == '__main__':
+    unittest.main()